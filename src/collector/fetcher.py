@@ -1,125 +1,163 @@
+import asyncio
 import datetime
-import requests
-import time
+import io
+from urllib.parse import urlsplit
+import aiohttp
+import ciso8601
+from aiolimiter import AsyncLimiter
+from lxml import etree
 from google_play_scraper import Sort, reviews as gps_reviews
-
-def fetch_ios_reviews(app_id, country, count=200):
+from tenacity import retry, retry_if_exception, retry_if_result, stop_after_attempt, wait_exponential_jitter
+
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=10)
+
+_IOS_XML_URL = "https://itunes.apple.com/{country}/rss/customerreviews/id={app_id}/sortBy=mostRecent/xml"
+
+# The XML feed uses the default namespace http://www.w3.org/2005/Atom plus the iTunes one,
+# so tags are matched in Clark notation ({namespace}tag), built once here.
+_ATOM = '{http://www.w3.org/2005/Atom}'
+_IM = '{http://itunes.apple.com/rss}'
+_TAG_ENTRY = f'{_ATOM}entry'
+_TAG_ID = f'{_ATOM}id'
+_TAG_UPDATED = f'{_ATOM}updated'
+_TAG_TITLE = f'{_ATOM}title'
+_TAG_CONTENT = f'{_ATOM}content'
+_PATH_AUTHOR_NAME = f'{_ATOM}author/{_ATOM}name'
+_TAG_RATING = f'{_IM}rating'
+_TAG_VERSION = f'{_IM}version'
+
+# Transient failures are retried with exponential backoff + jitter
+RETRY_STATUSES = (429, 502, 503, 504)
+MAX_ATTEMPTS = 5
+
+# Token bucket per host: at most RATE_LIMIT requests every RATE_PERIOD seconds
+RATE_LIMIT = 10
+RATE_PERIOD = 1
+_limiters = {}
+
+# Reviews requested per Google Play page when fetching incrementally
+ANDROID_PAGE_SIZE = 50
+
+def _limiter_for(host):
+    if host not in _limiters:
+        _limiters[host] = AsyncLimiter(RATE_LIMIT, RATE_PERIOD)
+    return _limiters[host]
+
+def _is_transient(exc):
+    """Whether a failed request is worth retrying (timeouts, dropped connections, 429/5xx)."""
+    if isinstance(exc, aiohttp.ClientResponseError):
+        return exc.status in RETRY_STATUSES
+    return isinstance(exc, (asyncio.TimeoutError, aiohttp.ClientConnectionError))
+
+def _is_failed_page(page):
     """
-    Fetches reviews from the Apple App Store using the RSS feed.
-    Note: RSS feed is limited to the last 500 reviews.
+    Whether a google_play_scraper page looks like a swallowed request error.
+    reviews() catches every fetch exception and returns an empty page with an
+    exhausted token instead, so that is the only failure signal it gives.
+    (An app with no reviews at all looks the same and is simply retried.)
     """
-    url = f"https://itunes.apple.com/{country}/rss/customerreviews/id={app_id}/sortBy=mostRecent/json"
-
-    try:
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        data = response.json()
-
-        feed = data.get('feed', {})
-        entries = feed.get('entry', [])
-
-        fetched_data = []
-        for entry in entries:
-            # Entry structure in RSS JSON
-            # 'id': {'label': '...'}, 'author': {'name': {'label': '...'}},
-            # 'im:rating': {'label': '5'}, 'title': {'label': '...'}, 'content': {'label': '...', 'attributes': {'type': 'text'}}
-            # 'im:version': {'label': '...'}
-
-            # Skip the first entry if it is the app info itself (sometimes happens in older feeds, but usually reviews are fine)
-            if 'im:rating' not in entry:
-                continue
-
-            review_id = entry.get('id', {}).get('label', '')
-            user_name = entry.get('author', {}).get('name', {}).get('label', 'Unknown')
-            title = entry.get('title', {}).get('label', '')
-            content = entry.get('content', {}).get('label', '')
-            rating = int(entry.get('im:rating', {}).get('label', '0'))
-            version = entry.get('im:version', {}).get('label', 'Unknown')
-
-            # Date handling is tricky in RSS, it might not be present or in a specific format?
-            # Actually, standard RSS JSON often lacks a clean timestamp in 'entry' for reviews compared to XML.
-            # Let's check if 'updated' or 'published' is there.
-            # Usually it's not in the JSON RSS for reviews explicitly for each item in a convenient way,
-            # BUT 'updated' is often at the top level.
-            # Wait, individual entries usually DO NOT have a timestamp in the iTunes JSON RSS feed.
-            # This is a known limitation of the JSON endpoint. The XML feed has it.
-            # However, for the sake of this task, if we can't get the date, we might assume "today" or skip it?
-            # No, that's bad for history.
-
-            # Let's switch to XML parsing if needed, or check if specific fields exist.
-            # Actually, let's use a known workaround or just use the XML endpoint which is richer.
-            # OR, we can try to use the library `app-store-scraper` logic but I decided to drop it.
-
-            # Re-evaluating: `app-store-scraper` uses the internal API which returns JSON and HAS dates.
-            # I should try to mimic that if possible, or use XML.
-            # XML Feed: https://itunes.apple.com/{country}/rss/customerreviews/id={app_id}/sortBy=mostRecent/xml
-            # XML has <updated> tag.
-
-            # For simplicity in Python, let's try to fetch XML and parse it?
-            # Or just use the JSON and see if I missed the date field.
-            # Checking online resources: The JSON feed indeed often lacks individual timestamps.
-
-            # Alternative: Use the internal API `https://amp-api.apps.apple.com/v1/catalog/{country}/apps/{app_id}/reviews`
-            # This requires a Bearer token.
-
-            # Let's stick to the RSS XML feed then, it's public and reliable for recent reviews.
-            # I will use `xml.etree.ElementTree`.
-            pass
-
-        # Call the XML fetcher instead
-        return fetch_ios_reviews_xml(app_id, country, count)
-
-    except Exception as e:
-        print(f"Error fetching iOS reviews (JSON) for {country}: {e}")
-        return []
+    result, token = page
+    return not result and token.token is None
+
+def _raise_failed_page(retry_state):
+    raise RuntimeError(f"Google Play returned no reviews after {retry_state.attempt_number} attempts")
+
+_retry_transient = retry(
+    stop=stop_after_attempt(MAX_ATTEMPTS),
+    wait=wait_exponential_jitter(initial=1, max=30),
+    retry=retry_if_exception(_is_transient),
+    reraise=True
+)
+
+@_retry_transient
+async def _get(session, url):
+    """GETs a URL and returns the response body, rate limited per host and retried on transient errors."""
+    async with _limiter_for(urlsplit(url).hostname):
+        async with session.get(url, timeout=REQUEST_TIMEOUT) as response:
+            response.raise_for_status()
+            return await response.read()
+
+def create_session():
+    """
+    Creates the HTTP session shared by all fetchers.
+    Connections are pooled and kept alive, so the TCP + TLS handshake to
+    itunes.apple.com is paid once per connection rather than once per country.
+    """
+    connector = aiohttp.TCPConnector(
+        limit=20,
+        limit_per_host=20,
+        keepalive_timeout=60,
+        ttl_dns_cache=300
+    )
+    return aiohttp.ClientSession(connector=connector, timeout=REQUEST_TIMEOUT)
+
+def _release(element):
+    """
+    Frees a parsed element and its already-processed siblings,
+    keeping iterparse memory usage constant regardless of feed size.
+    """
+    element.clear()
+    while element.getprevious() is not None:
+        del element.getparent()[0]
 
-def fetch_ios_reviews_xml(app_id, country, count=200):
-    url = f"https://itunes.apple.com/{country}/rss/customerreviews/id={app_id}/sortBy=mostRecent/xml"
-    import xml.etree.ElementTree as ET
+async def fetch_ios_reviews_xml(session, app_id, country, count=200, since=None):
+    """
+    Fetches reviews from the Apple App Store XML RSS feed (sorted by most recent).
+    If `since` is given, parsing stops at the first review at or before that watermark.
+    Returns (reviews, watermark). watermark is the newest review date, or None
+    when the fetch stopped at `count` before reaching `since` or the end of the
+    feed, since advancing to it would skip the reviews in between.
+    """
+    url = _IOS_XML_URL.format(country=country, app_id=app_id)
 
     try:
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-
-        # Namespace handling is annoying in ET, so we strip it or handle it.
-        # The feed uses default namespace usually http://www.w3.org/2005/Atom
-
-        root = ET.fromstring(response.content)
-        # Find all entries. Namespace aware?
-        # Let's just iterate and look for local names.
+        body = await _get(session, url)
 
         fetched_data = []
-        ns = {'atom': 'http://www.w3.org/2005/Atom', 'im': 'http://itunes.apple.com/rss'}
-
-        # The first entry is often the app metadata, need to skip it.
-        # Reviews usually start from the second entry or we check for 'im:rating'.
-
-        for entry in root.findall('atom:entry', ns):
-            # Check if it's a review
-            rating_tag = entry.find('im:rating', ns)
+        newest = None
+        reached_since = False
+        truncated = False
+
+        # Stream entries one by one instead of building the whole tree,
+        # so we can stop as soon as `count` reviews have been collected.
+        context = etree.iterparse(io.BytesIO(body), events=('end',), tag=_TAG_ENTRY)
+
+        for _, entry in context:
+            # The first entry is often the app metadata, need to skip it.
+            # Reviews are the entries that have 'im:rating'.
+            rating_tag = entry.find(_TAG_RATING)
             if rating_tag is None:
+                _release(entry)
                 continue
 
-            review_id = entry.find('atom:id', ns).text
-            updated = entry.find('atom:updated', ns).text # ISO format e.g. 2024-05-21T07:00:00-07:00
-            user_name = entry.find('atom:author', ns).find('atom:name', ns).text
-            title = entry.find('atom:title', ns).text
-            content = entry.find('atom:content', ns).text
+            review_id = entry.find(_TAG_ID).text
+            updated = entry.find(_TAG_UPDATED).text # ISO format e.g. 2024-05-21T07:00:00-07:00
+            user_name = entry.find(_PATH_AUTHOR_NAME).text
+            title = entry.find(_TAG_TITLE).text
+            content = entry.find(_TAG_CONTENT).text
             rating = int(rating_tag.text)
-            version = entry.find('im:version', ns).text
+            version = entry.find(_TAG_VERSION).text
+            _release(entry)
 
-            # Parse date
-            try:
-                # updated string is ISO 8601. 3.9+ supports fromisoformat.
-                dt = datetime.datetime.fromisoformat(updated)
-                # Ensure UTC
+            # Parse date (ISO 8601), normalized to UTC
+            if updated:
+                dt = ciso8601.parse_datetime(updated)
                 if dt.tzinfo is None:
                     dt = dt.replace(tzinfo=datetime.timezone.utc)
                 else:
                     dt = dt.astimezone(datetime.timezone.utc)
-            except:
+            else:
                 dt = datetime.datetime.now(datetime.timezone.utc) # Fallback
 
+            # The feed is sorted newest first, so everything from here on is already stored
+            if since is not None and dt <= since:
+                reached_since = True
+                break
+
+            # Fallback dates are not real review dates and must not move the watermark
+            if updated and (newest is None or dt > newest):
+                newest = dt
+
             fetched_data.append({
                 'source': 'ios',
                 'id': review_id,
@@ -133,58 +171,98 @@ def fetch_ios_reviews_xml(app_id, country, count=200):
             })
 
             if len(fetched_data) >= count:
+                truncated = True
                 break
 
-        return fetched_data
+        complete = since is None or reached_since or not truncated
+        return fetched_data, newest if complete else None
 
     except Exception as e:
         print(f"Error fetching iOS reviews (XML) for {country}: {e}")
-        return []
-
-def fetch_android_reviews(package_name, country, count=200):
+        return [], None
+
+@retry(
+    stop=stop_after_attempt(MAX_ATTEMPTS),
+    wait=wait_exponential_jitter(initial=1, max=30),
+    retry=retry_if_result(_is_failed_page),
+    retry_error_callback=_raise_failed_page
+)
+async def _fetch_android_page(package_name, **kwargs):
+    """Runs the synchronous google_play_scraper call in the default executor, rate limited and retried."""
+    async with _limiter_for('play.google.com'):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, lambda: gps_reviews(package_name, **kwargs))
+
+async def fetch_android_reviews(package_name, country, count=200, since=None):
     """
     Fetches reviews from Google Play Store.
+    google_play_scraper is synchronous, so the call is offloaded to the default executor.
+    If `since` is given, reviews are requested page by page (via the continuation token)
+    and fetching stops at the first review at or before that watermark.
+    Returns (reviews, watermark) like fetch_ios_reviews_xml.
     """
     try:
         lang = country if country in ['jp', 'en', 'ko'] else 'en'
-
-        result, _ = gps_reviews(
-            package_name,
-            lang=lang,
-            country=country,
-            sort=Sort.NEWEST,
-            count=count
-        )
+        page_size = count if since is None else min(count, ANDROID_PAGE_SIZE)
 
         fetched_data = []
-        for r in result:
-            dt = r.get('at')
-            if dt:
-                # Android scraper usually returns naive datetime (local time of the server? or UTC?)
-                # Usually it's UTC but naive. Let's force UTC.
-                if dt.tzinfo is None:
-                    dt = dt.replace(tzinfo=datetime.timezone.utc)
-                else:
-                    dt = dt.astimezone(datetime.timezone.utc)
-
-            fetched_data.append({
-                'source': 'android',
-                'id': r.get('reviewId'),
-                'user_name': r.get('userName'),
-                'date': dt,
-                'rating': r.get('score'),
-                'title': '',
-                'content': r.get('content'),
-                'version': r.get('reviewCreatedVersion', 'Unknown'), # Sometimes None
-                'country': country
-            })
+        token = None
+        reached_watermark = False
+        exhausted = False
+        while len(fetched_data) < count:
+            result, token = await _fetch_android_page(
+                package_name,
+                lang=lang,
+                country=country,
+                sort=Sort.NEWEST,
+                count=page_size,
+                continuation_token=token
+            )
+
+            for r in result:
+                dt = r.get('at')
+                if dt:
+                    # Android scraper usually returns naive datetime (local time of the server? or UTC?)
+                    # Usually it's UTC but naive. Let's force UTC.
+                    if dt.tzinfo is None:
+                        dt = dt.replace(tzinfo=datetime.timezone.utc)
+                    else:
+                        dt = dt.astimezone(datetime.timezone.utc)
+
+                    # Sorted newest first, so everything from here on is already stored
+                    if since is not None and dt <= since:
+                        reached_watermark = True
+                        break
+
+                fetched_data.append({
+                    'source': 'android',
+                    'id': r.get('reviewId'),
+                    'user_name': r.get('userName'),
+                    'date': dt,
+                    'rating': r.get('score'),
+                    'title': '',
+                    'content': r.get('content'),
+                    'version': r.get('reviewCreatedVersion', 'Unknown'), # Sometimes None
+                    'country': country
+                })
+
+            # token.token is None once the last page has been read; asking again
+            # would return an empty page, indistinguishable from a failure
+            exhausted = token.token is None
+            if since is None or reached_watermark or exhausted:
+                break
 
         # Ensure version is not None
         for r in fetched_data:
             if r['version'] is None:
                 r['version'] = 'Unknown'
 
-        return fetched_data
+        # Stopping at `count` before the watermark / end of feed leaves a gap,
+        # so only a fetch that covered everything since `since` may advance it
+        complete = since is None or ((reached_watermark or exhausted) and len(fetched_data) <= count)
+        fetched_data = fetched_data[:count]
+        dates = [r['date'] for r in fetched_data if r['date']]
+        return fetched_data, max(dates) if complete and dates else None
     except Exception as e:
         print(f"Error fetching Android reviews for {country}: {e}")
-        return []
+        return [], None
@@ -1,8 +1,9 @@
 import yaml
 import os
 import argparse
+import asyncio
 from dotenv import load_dotenv
-from fetcher import fetch_ios_reviews, fetch_android_reviews
+from fetcher import create_session, fetch_ios_reviews_xml, fetch_android_reviews
 from storage import StorageManager
 
 # Load environment variables from .env file if present
@@ -12,6 +13,67 @@ def load_config():
     with open('config.yaml', 'r') as f:
         return yaml.safe_load(f)
 
+# Max concurrent requests per host, to stay under iTunes / Play rate limits
+MAX_CONCURRENCY_PER_HOST = 16
+
+def watermark_key(source, app_store_id, country):
+    return f"{source}:{app_store_id}:{country}"
+
+async def fetch_all_reviews(config, watermarks):
+    """
+    Fetches reviews for every (app, country) pair concurrently.
+    Only reviews newer than the stored watermark of each pair are fetched.
+    Returns (reviews, new watermarks keyed like `watermarks`). A pair only gets a
+    new watermark when its fetch covered everything since the previous one.
+    """
+    semaphores = {
+        'ios': asyncio.Semaphore(MAX_CONCURRENCY_PER_HOST),
+        'android': asyncio.Semaphore(MAX_CONCURRENCY_PER_HOST),
+    }
+
+    async def bounded(source, coro):
+        async with semaphores[source]:
+            return await coro
+
+    labels = []
+    tasks = []
+
+    async with create_session() as session:
+        for app in config['apps']:
+            for country in app['countries']:
+                # iOS
+                if 'ios_id' in app:
+                    key = watermark_key('ios', app['ios_id'], country)
+                    labels.append((app['name'], 'iOS', country, key))
+                    tasks.append(bounded('ios', fetch_ios_reviews_xml(
+                        session, app['ios_id'], country, since=watermarks.get(key)
+                    )))
+
+                # Android
+                if 'android_id' in app:
+                    key = watermark_key('android', app['android_id'], country)
+                    labels.append((app['name'], 'Android', country, key))
+                    tasks.append(bounded('android', fetch_android_reviews(
+                        app['android_id'], country, since=watermarks.get(key)
+                    )))
+
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+
+    all_reviews = []
+    new_watermarks = {}
+    for (app_name, source, country, key), result in zip(labels, results):
+        if isinstance(result, Exception):
+            print(f"  [{app_name}] {source} {country}: failed ({result})")
+            continue
+        reviews, watermark = result
+        print(f"  [{app_name}] {source} {country}: got {len(reviews)} new reviews.")
+        all_reviews.extend(reviews)
+
+        if watermark is not None:
+            new_watermarks[key] = watermark
+
+    return all_reviews, new_watermarks
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--local', action='store_true', help='Run locally without GCS')
@@ -22,33 +84,22 @@ def main():
     # Environment variable overrides config if present
     bucket_name = os.environ.get('GCS_BUCKET_NAME', config['storage']['bucket_name'])
 
-    storage = StorageManager(bucket_name, local_run=args.local)
+    storage = StorageManager(
+        bucket_name,
+        local_run=args.local,
+        write_json=config['storage'].get('write_json', False)
+    )
     base_path = config['storage']['base_path']
 
-    all_reviews = []
-
-    for app in config['apps']:
-        print(f"Processing App: {app['name']}")
-        for country in app['countries']:
-            print(f"  Fetching for country: {country}")
-
-            # iOS
-            if 'ios_id' in app:
-                print(f"    Fetching iOS...")
-                ios_reviews = fetch_ios_reviews(app['ios_id'], country)
-                print(f"      Got {len(ios_reviews)} reviews.")
-                all_reviews.extend(ios_reviews)
-
-            # Android
-            if 'android_id' in app:
-                print(f"    Fetching Android...")
-                android_reviews = fetch_android_reviews(app['android_id'], country)
-                print(f"      Got {len(android_reviews)} reviews.")
-                all_reviews.extend(android_reviews)
+    print("Fetching reviews...")
+    watermarks = storage.load_watermarks(base_path)
+    all_reviews, new_watermarks = asyncio.run(fetch_all_reviews(config, watermarks))
 
     if all_reviews:
         print(f"Saving {len(all_reviews)} reviews total...")
         storage.save_reviews(all_reviews, base_path=base_path)
+        # Only advance watermarks once the reviews they cover are stored
+        storage.update_watermarks(new_watermarks, base_path)
     else:
         print("No reviews fetched.")
 
@@ -1,162 +1,312 @@
-import json
+import gzip
+import io
 import os
-from google.cloud import storage
+import posixpath
+from pathlib import Path
+import orjson
 import datetime
+import pandas as pd
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+# Partition files are independent, so their reads/writes are fanned out
+# over a thread pool (the GCS client releases the GIL during HTTP calls).
+IO_MAX_WORKERS = 16
+
+LOCAL_DATA_DIR = Path("data_local")
+
+# Timestamps are not serialized natively by orjson, hence default=str at the call sites
+JSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+def _json_path(parquet_path):
+    """Legacy JSON location of a partition, e.g. reviews/jp/2024/05.json"""
+    return parquet_path[:-len('.parquet')] + '.json'
+
+def _ids_path(parquet_path):
+    """ID sidecar of a partition, e.g. reviews/jp/2024/05.ids.parquet"""
+    return parquet_path[:-len('.parquet')] + '.ids.parquet'
 
 class StorageManager:
-    def __init__(self, bucket_name, local_run=False):
+    def __init__(self, bucket_name, local_run=False, write_json=False):
         self.bucket_name = bucket_name
         self.local_run = local_run
+        # Migration flag: also write the legacy JSON partitions next to the Parquet ones
+        self.write_json = write_json
         if not local_run and bucket_name:
+            # Imported lazily: google-cloud-storage is slow to import and unused in --local runs
+            from google.cloud import storage
             self.client = storage.Client()
             self.bucket = self.client.bucket(bucket_name)
         else:
             self.client = None
             self.bucket = None
             # Ensure local directories exist
-            os.makedirs("data_local", exist_ok=True)
+            LOCAL_DATA_DIR.mkdir(exist_ok=True)
 
     def _read_json(self, path):
         if self.local_run or not self.bucket:
-            local_path = os.path.join("data_local", path)
-            if os.path.exists(local_path):
-                with open(local_path, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            return None
+            try:
+                return orjson.loads((LOCAL_DATA_DIR / path).read_bytes())
+            except FileNotFoundError:
+                return None
         else:
-            blob = self.bucket.blob(path)
-            if blob.exists():
-                return json.loads(blob.download_as_string())
-            return None
+            from google.api_core.exceptions import NotFound
+            try:
+                # Single GET (no exists() HEAD); gzip content-encoding is decoded transparently by the client
+                return orjson.loads(self.bucket.blob(path).download_as_bytes())
+            except NotFound:
+                return None
+
+    def _read_parquet(self, path):
+        if self.local_run or not self.bucket:
+            try:
+                return pd.read_parquet(LOCAL_DATA_DIR / path, engine='pyarrow')
+            except FileNotFoundError:
+                return None
+        else:
+            from google.api_core.exceptions import NotFound
+            try:
+                return pd.read_parquet(io.BytesIO(self.bucket.blob(path).download_as_bytes()), engine='pyarrow')
+            except NotFound:
+                return None
+
+    def _read_many(self, paths, reader=None):
+        """
+        Reads several files concurrently (JSON unless another reader is given),
+        returning None for missing ones.
+        In local mode, existence is checked with one scandir per directory
+        instead of one failed open per missing file.
+        """
+        to_read = paths
+        if self.local_run or not self.bucket:
+            present = set()
+            for directory in {posixpath.dirname(p) for p in paths}:
+                try:
+                    with os.scandir(LOCAL_DATA_DIR / directory) as it:
+                        present.update(f"{directory}/{e.name}" for e in it if e.is_file())
+                except FileNotFoundError:
+                    pass
+            to_read = [p for p in paths if p in present]
+
+        with ThreadPoolExecutor(max_workers=IO_MAX_WORKERS) as ex:
+            results = dict(zip(to_read, ex.map(reader or self._read_json, to_read)))
+        return [results.get(p) for p in paths]
 
     def _write_json(self, path, data):
         if self.local_run or not self.bucket:
-            local_path = os.path.join("data_local", path)
-            os.makedirs(os.path.dirname(local_path), exist_ok=True)
-            with open(local_path, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2, default=str)
+            local_path = LOCAL_DATA_DIR / path
+            local_path.parent.mkdir(parents=True, exist_ok=True)
+            local_path.write_bytes(orjson.dumps(data, option=JSON_OPTIONS | orjson.OPT_INDENT_2, default=str))
             print(f"Saved locally to {local_path}")
         else:
+            raw = orjson.dumps(data, option=JSON_OPTIONS, default=str)
             blob = self.bucket.blob(path)
+            blob.content_encoding = 'gzip'
             blob.upload_from_string(
-                json.dumps(data, ensure_ascii=False, default=str),
+                gzip.compress(raw),
                 content_type='application/json'
             )
             print(f"Uploaded to gs://{self.bucket_name}/{path}")
 
+    def _write_parquet(self, path, df):
+        # Low-cardinality columns (version, country, source, rating) dictionary-encode well
+        raw = df.to_parquet(None, engine='pyarrow', compression='zstd', index=False)
+        if self.local_run or not self.bucket:
+            local_path = LOCAL_DATA_DIR / path
+            local_path.parent.mkdir(parents=True, exist_ok=True)
+            local_path.write_bytes(raw)
+            print(f"Saved locally to {local_path}")
+        else:
+            blob = self.bucket.blob(path)
+            blob.upload_from_string(raw, content_type='application/vnd.apache.parquet')
+            print(f"Uploaded to gs://{self.bucket_name}/{path}")
+
     def save_reviews(self, reviews, base_path="reviews"):
         """
         Saves reviews to partitioned files and updates the index.
         reviews: List of dicts (must have 'date', 'country', 'version')
         """
         # 1. Group by Country and Year-Month
-        grouped = {}
-        for r in reviews:
-            dt = r['date']
-            if isinstance(dt, str):
-                dt = datetime.datetime.fromisoformat(dt)
+        df = pd.DataFrame(reviews)
+        df['date'] = pd.to_datetime(df['date'], utc=True, format='ISO8601')
+        df['ym'] = df['date'].dt.strftime('%Y/%m')
+
+        groups = [
+            (country, ym, group_df.drop(columns='ym'))
+            for (country, ym), group_df in df.groupby(['country', 'ym'], sort=False)
+        ]
+        paths = [f"{base_path}/{country}/{ym}.parquet" for country, ym, _ in groups]
+
+        # 2. Drop reviews we already have, using each partition's small ID sidecar,
+        # so partitions that received nothing new are neither read nor rewritten.
+        known_ids = self._read_many([_ids_path(path) for path in paths], self._read_parquet)
+        pending = []
+        for path, (country, ym, new_df), ids_df in zip(paths, groups, known_ids):
+            new_df = new_df.drop_duplicates('id', keep='first')
+            if ids_df is not None:
+                new_df = new_df[~new_df['id'].isin(ids_df['id'])]
+                if new_df.empty:
+                    continue
+            pending.append((path, country, ym, new_df))
 
-            ym = dt.strftime('%Y/%m')
-            country = r['country']
-            key = (country, ym)
+        if not pending:
+            print("No new reviews to save.")
+            return
 
-            if key not in grouped:
-                grouped[key] = []
-            grouped[key].append(r)
+        # 3. Load existing data for the remaining groups (in parallel), merge, and save.
+        # Partitions not yet migrated to Parquet are read from their legacy JSON file.
+        paths = [path for path, _, _, _ in pending]
+        existing = self._read_many(paths, self._read_parquet)
+        legacy_paths = [_json_path(path) for path, existing_df in zip(paths, existing) if existing_df is None]
+        legacy = dict(zip(legacy_paths, self._read_many(legacy_paths)))
 
-        # 2. Load existing data for these groups, merge, and save
         affected_files = [] # List of paths that were updated
 
-        for (country, ym), new_reviews in grouped.items():
-            path = f"{base_path}/{country}/{ym}.json"
-            existing_reviews = self._read_json(path) or []
-
-            # Normalize existing reviews date field to datetime object (timezone-aware)
-            for r in existing_reviews:
-                if isinstance(r.get('date'), str):
-                    try:
-                        dt = datetime.datetime.fromisoformat(r['date'])
-                        if dt.tzinfo is None:
-                            dt = dt.replace(tzinfo=datetime.timezone.utc)
-                        r['date'] = dt
-                    except ValueError:
-                        pass # Keep as string if parsing fails (should not happen)
-
-            # Merge logic: Deduplicate by ID
-            existing_ids = {r['id'] for r in existing_reviews}
-            merged = existing_reviews
-            for nr in new_reviews:
-                if nr['id'] not in existing_ids:
-                    merged.append(nr)
-                    existing_ids.add(nr['id'])
-
-            # Sort by date desc
-            # Ensure all dates are comparable (datetime objects).
-            # If any str remains, convert blindly or handle error?
-            # We already converted existing ones above. New ones are already datetime.
-            merged.sort(key=lambda x: x['date'] if isinstance(x['date'], datetime.datetime) else datetime.datetime.min.replace(tzinfo=datetime.timezone.utc), reverse=True)
-
-            self._write_json(path, merged)
+        for (path, country, ym, new_df), existing_df in zip(pending, existing):
+            if existing_df is None and legacy.get(_json_path(path)):
+                existing_df = pd.DataFrame(legacy[_json_path(path)])
+                # Normalize existing reviews date field to timezone-aware datetimes
+                existing_df['date'] = pd.to_datetime(existing_df['date'], utc=True, format='ISO8601')
+
+            if existing_df is not None and not existing_df.empty:
+                merged_df = pd.concat([existing_df, new_df], ignore_index=True)
+            else:
+                merged_df = new_df
+
+            # Merge logic: Deduplicate by ID (existing reviews win), then sort by date desc
+            merged_df = (
+                merged_df
+                .drop_duplicates('id', keep='first')
+                .sort_values('date', ascending=False, kind='stable')
+                .reset_index(drop=True)
+            )
+
             affected_files.append({
                 'path': path,
                 'country': country,
                 'ym': ym,
-                'reviews': merged
+                'reviews': merged_df
             })
 
-        # 3. Update Index
+        def write_partition(info):
+            self._write_parquet(info['path'], info['reviews'])
+            # Written after the partition, so a stale sidecar can only under-report IDs
+            self._write_parquet(_ids_path(info['path']), info['reviews'][['id']])
+            if self.write_json:
+                self._write_json(_json_path(info['path']), info['reviews'].to_dict('records'))
+
+        with ThreadPoolExecutor(max_workers=IO_MAX_WORKERS) as ex:
+            # list() forces completion and re-raises any write error
+            list(ex.map(write_partition, affected_files))
+
+        # 4. Update Index
         self.update_index(affected_files, base_path)
 
-    def update_index(self, updated_files_info, base_path):
+    def load_watermarks(self, base_path="reviews"):
+        """
+        Returns the newest collected review date per fetch key
+        (e.g. 'ios:443904275:jp'), used to fetch only newer reviews.
+        """
+        data = self._read_json(f"{base_path}/watermarks.json") or {}
+        return {
+            key: datetime.datetime.fromisoformat(value)
+            for key, value in data.get("watermarks", {}).items()
+        }
+
+    def update_watermarks(self, updates, base_path="reviews"):
         """
-        Updates the global index.json with version mappings.
-        updated_files_info: list of dicts with keys 'path', 'country', 'ym', 'reviews'
+        Advances the stored watermarks; a watermark never moves backwards.
+        updates: dict of fetch key -> timezone-aware datetime
         """
-        index_path = f"{base_path}/index.json"
-        index_data = self._read_json(index_path) or {"versions": {}, "updated_at": ""}
+        if not updates:
+            return
 
-        # Structure of index.json:
+        path = f"{base_path}/watermarks.json"
+        watermarks = self.load_watermarks(base_path)
+        for key, dt in updates.items():
+            if key not in watermarks or watermarks[key] < dt:
+                watermarks[key] = dt
+
+        self._write_json(path, {
+            "updated_at": datetime.datetime.now().isoformat(),
+            "watermarks": {key: dt.isoformat() for key, dt in watermarks.items()}
+        })
+
+    def update_index(self, updated_files_info, base_path):
+        """
+        Updates the per-country version indexes and the countries manifest.
+        Only the shards of the countries touched by this run are read and rewritten.
+        updated_files_info: list of dicts with keys 'path', 'country', 'ym', 'reviews' (merged DataFrame)
+        """
+        # Layout:
+        # {base_path}/index/countries.json
+        # {
+        #   "updated_at": "...",
+        #   "countries": ["jp", "us"]
+        # }
+        # {base_path}/index/{country}.json
         # {
         #   "updated_at": "...",
         #   "versions": {
-        #       "13.4.0": {
-        #           "jp": ["2024/05", "2024/06"],
-        #           "us": ["2024/05"]
-        #       }
+        #       "13.4.0": ["2024/05", "2024/06"],
+        #       "13.3.0": ["2024/05"]
         #   }
         # }
+        index_dir = f"{base_path}/index"
+        now = datetime.datetime.now().isoformat()
 
-        if "versions" not in index_data:
-            index_data["versions"] = {}
-
+        by_country = {}
         for info in updated_files_info:
-            country = info['country']
-            ym = info['ym']
-            # We need to scan the FULL content of this updated file to know which versions are in it.
-            # (Because we might have added a new version to an existing month,
-            #  or the file might already have had versions we need to preserve)
-
-            # Extract all unique versions in this file
-            versions_in_file = set()
-            for r in info['reviews']:
-                v = r.get('version')
-                if not v:
-                    v = "Unknown"
-                versions_in_file.add(v)
-
-            # Update the global map
-            for v in versions_in_file:
-                if v not in index_data["versions"]:
-                    index_data["versions"][v] = {}
-
-                if country not in index_data["versions"][v]:
-                    index_data["versions"][v][country] = []
-
-                # Add this YM if not present
-                if ym not in index_data["versions"][v][country]:
-                    index_data["versions"][v][country].append(ym)
-                    # Keep sorted?
-                    index_data["versions"][v][country].sort()
-
-        index_data["updated_at"] = datetime.datetime.now().isoformat()
-        self._write_json(index_path, index_data)
+            by_country.setdefault(info['country'], []).append(info)
+        countries = list(by_country)
+
+        manifest_path = f"{index_dir}/countries.json"
+        shard_paths = [f"{index_dir}/{country}.json" for country in countries]
+        manifest, *shards = self._read_many([manifest_path] + shard_paths)
+
+        # Seed missing shards / manifest from the legacy global index.json, if any
+        legacy_versions = {}
+        if manifest is None or None in shards:
+            legacy_versions = (self._read_json(f"{base_path}/index.json") or {}).get("versions", {})
+
+        if manifest is None:
+            # First sharded run: migrate every legacy country, not just the ones touched now
+            legacy_countries = sorted({c for m in legacy_versions.values() for c in m} - set(countries))
+            for country in legacy_countries:
+                by_country[country] = []
+                countries.append(country)
+                shard_paths.append(f"{index_dir}/{country}.json")
+                shards.append(None)
+            manifest = {"countries": []}
+
+        for i, (country, shard) in enumerate(zip(countries, shards)):
+            if shard is None:
+                shard = {"versions": {
+                    v: list(country_map[country])
+                    for v, country_map in legacy_versions.items() if country in country_map
+                }}
+
+            # Work on sets so membership checks are O(1); lists are sorted once on write
+            index_sets = defaultdict(set, {v: set(yms) for v, yms in shard.get("versions", {}).items()})
+
+            for info in by_country[country]:
+                # We need to scan the FULL content of this updated file to know which versions are in it.
+                # (Because we might have added a new version to an existing month,
+                #  or the file might already have had versions we need to preserve)
+                versions_in_file = info['reviews']['version'].fillna("Unknown").replace("", "Unknown").unique()
+                for v in versions_in_file:
+                    index_sets[v].add(info['ym'])
+
+            shard["versions"] = {v: sorted(yms) for v, yms in index_sets.items()}
+            shard["updated_at"] = now
+            shards[i] = shard
+
+        with ThreadPoolExecutor(max_workers=IO_MAX_WORKERS) as ex:
+            list(ex.map(self._write_json, shard_paths, shards))
+
+        # Countries manifest is append-only; rewrite it only when a new country shows up
+        known = manifest.get("countries", [])
+        if not set(countries) <= set(known):
+            manifest["countries"] = sorted(set(known) | set(countries))
+            manifest["updated_at"] = now
+            self._write_json(manifest_path, manifest)
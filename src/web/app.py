@@ -1,9 +1,14 @@
 import streamlit as st
 import pandas as pd
-import json
+import numpy as np
+import io
 import os
+import orjson
 from datetime import datetime
-from google.cloud import storage
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from dotenv import load_dotenv
 
 # Load environment variables from .env file if present
@@ -66,7 +71,11 @@ st.markdown("""
 def get_storage_client():
     # If running locally without auth env vars, this might fail unless using a key file.
     # We assume the user sets up GOOGLE_APPLICATION_CREDENTIALS or runs locally in 'local mode'.
+    if BUCKET_NAME == 'YOUR_GCS_BUCKET_NAME':
+        return None # No bucket configured: local-only, don't touch the GCS stack at all
     try:
+        # Imported lazily so local-only use never pays for loading google-cloud-storage
+        from google.cloud import storage
         return storage.Client()
     except:
         return None
@@ -75,65 +84,150 @@ BUCKET_NAME = os.environ.get('GCS_BUCKET_NAME', 'YOUR_GCS_BUCKET_NAME')
 BASE_PATH = "reviews"
 LOCAL_DATA_DIR = "data_local" # For local testing fallback
 
-def load_json(path, client=None):
+# Columns needed for filtering and display (Parquet reads only these)
+REVIEW_COLUMNS = ['date', 'rating', 'version', 'country', 'source', 'user_name', 'title', 'content']
+
+PAGE_SIZE = 50 # Review cards rendered per page
+STARS = ["★" * i + "☆" * (5 - i) for i in range(6)] # Indexed by rating
+
+@st.cache_resource
+def get_bucket():
+    client = get_storage_client()
+    if client is None:
+        return None
+    return client.bucket(BUCKET_NAME)
+
+def load_json(path, bucket=None):
     """Loads JSON from GCS or local fallback."""
-    if client and BUCKET_NAME != 'YOUR_GCS_BUCKET_NAME':
+    if bucket:
+        from google.api_core.exceptions import NotFound
         try:
-            bucket = client.bucket(BUCKET_NAME)
-            blob = bucket.blob(path)
-            if blob.exists():
-                return json.loads(blob.download_as_string())
+            # Single GET; a missing blob surfaces as NotFound instead of a separate exists() HEAD
+            return orjson.loads(bucket.blob(path).download_as_bytes())
+        except NotFound:
+            pass
         except Exception as e:
             st.warning(f"Failed to load from GCS: {e}")
             pass
 
     # Fallback to local
-    local_path = os.path.join(LOCAL_DATA_DIR, path)
-    if os.path.exists(local_path):
-        with open(local_path, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return None
+    try:
+        return orjson.loads(Path(LOCAL_DATA_DIR, path).read_bytes())
+    except FileNotFoundError:
+        return None
 
 @st.cache_data(ttl=3600)
-def load_index():
+def load_legacy_index():
+    """
+    Loads the pre-sharding global index.json ({version: {country: [YYYY/MM]}}).
+    Only used until the collector has written the sharded index.
+    """
     path = f"{BASE_PATH}/index.json"
-    client = get_storage_client()
-    data = load_json(path, client)
+    data = load_json(path, get_bucket())
     if not data:
-        return {"versions": {}}
-    return data
+        return {}
+    return data.get("versions", {})
+
+@st.cache_data(ttl=3600)
+def load_countries():
+    """Loads the small countries manifest used to populate the Country dropdown."""
+    path = f"{BASE_PATH}/index/countries.json"
+    data = load_json(path, get_bucket())
+    if not data:
+        # Not migrated yet: derive the countries from the legacy index
+        return sorted({c for country_map in load_legacy_index().values() for c in country_map})
+    return data.get("countries", [])
+
+@st.cache_data(ttl=3600)
+def load_country_index(country):
+    """Loads the version -> [YYYY/MM] map for a single country."""
+    path = f"{BASE_PATH}/index/{country}.json"
+    data = load_json(path, get_bucket())
+    if not data:
+        # Not migrated yet: extract this country's map from the legacy index
+        return {
+            v: country_map[country]
+            for v, country_map in load_legacy_index().items() if country in country_map
+        }
+    return data.get("versions", {})
+
+def load_parquet(path, bucket=None):
+    """Loads a Parquet partition (only the displayed columns) from GCS or local fallback."""
+    if bucket:
+        from google.api_core.exceptions import NotFound
+        try:
+            raw = bucket.blob(path).download_as_bytes()
+            return pd.read_parquet(io.BytesIO(raw), columns=REVIEW_COLUMNS, engine='pyarrow')
+        except NotFound:
+            pass
+        except Exception as e:
+            st.warning(f"Failed to load from GCS: {e}")
+            pass
+
+    # Fallback to local
+    try:
+        return pd.read_parquet(Path(LOCAL_DATA_DIR, path), columns=REVIEW_COLUMNS, engine='pyarrow')
+    except FileNotFoundError:
+        return None
+
+def load_partition(path, bucket=None):
+    """
+    Loads one month partition as a DataFrame.
+    Falls back to the legacy JSON file for partitions not yet written as Parquet.
+    """
+    df = load_parquet(path, bucket)
+    if df is not None:
+        return df
+
+    data = load_json(path[:-len('.parquet')] + '.json', bucket)
+    if not data:
+        return None
+    df = pd.DataFrame(data).reindex(columns=REVIEW_COLUMNS)
+    df['date'] = pd.to_datetime(df['date'], utc=True, format='ISO8601')
+    return df
 
-@st.cache_data(ttl=600)
 def load_reviews_data(files_to_load):
     """
-    Loads multiple JSON files and combines them.
-    files_to_load: List of paths relative to bucket root (e.g. reviews/jp/2024/05.json)
+    Loads multiple partitions and returns their DataFrames.
+    files_to_load: List of paths relative to bucket root (e.g. reviews/jp/2024/05.parquet)
     """
-    client = get_storage_client()
-    all_reviews = []
+    bucket = get_bucket()
 
-    for path in files_to_load:
-        data = load_json(path, client)
-        if data:
-            all_reviews.extend(data)
+    # Each file is a separate round-trip, so fetch them concurrently.
+    # Workers get the script context so st.warning() from the loaders still renders.
+    ctx = get_script_run_ctx()
+    with ThreadPoolExecutor(max_workers=16, initializer=add_script_run_ctx, initargs=(None, ctx)) as ex:
+        frames = [df for df in ex.map(partial(load_partition, bucket=bucket), files_to_load) if df is not None]
 
-    return all_reviews
+    return frames
+
+@st.cache_data(ttl=600)
+def build_dataframe(files_to_load):
+    """
+    Loads the given files into a DataFrame ready for filtering.
+    Cached per file-set, so the per-column preprocessing (lowercased
+    search columns) runs once rather than on every interaction.
+    files_to_load: Sorted list of paths (sorted so the cache key is stable)
+    """
+    frames = load_reviews_data(files_to_load)
+    if not frames:
+        return None
+
+    df = pd.concat(frames, ignore_index=True)
+
+    # Lowercased copies for keyword search
+    df['_content_lc'] = df['content'].str.lower()
+    df['_title_lc'] = df['title'].str.lower()
+
+    return df
 
 # --- Main App Logic ---
 
 def main():
     st.title("📱 App Review Viewer")
 
-    # 1. Load Index
-    index_data = load_index()
-    versions_map = index_data.get("versions", {})
-
-    # Calculate available countries and versions from index
-    available_versions = sorted(versions_map.keys(), reverse=True)
-    available_countries = set()
-    for v_data in versions_map.values():
-        available_countries.update(v_data.keys())
-    available_countries = sorted(list(available_countries))
+    # 1. Load Index (countries first, then only the selected country's versions)
+    available_countries = load_countries()
     if not available_countries:
         available_countries = ['jp'] # Default fallback
 
@@ -143,6 +237,9 @@ def main():
     # Country Filter
     selected_country = st.sidebar.selectbox("Country", available_countries, index=0)
 
+    versions_map = load_country_index(selected_country)
+    available_versions = sorted(versions_map.keys(), reverse=True)
+
     # Version Filter (Optional)
     use_version_filter = st.sidebar.checkbox("Filter by Version")
     selected_version = None
@@ -171,26 +268,21 @@ def main():
 
     if use_version_filter and selected_version:
         # Load specific files for this version
-        if selected_version in versions_map and selected_country in versions_map[selected_version]:
-            ym_list = versions_map[selected_version][selected_country]
+        if selected_version in versions_map:
+            ym_list = versions_map[selected_version]
             for ym in ym_list:
-                files_to_load.add(f"{BASE_PATH}/{selected_country}/{ym}.json")
+                files_to_load.add(f"{BASE_PATH}/{selected_country}/{ym}.parquet")
         else:
             st.warning(f"No data found for Version {selected_version} in {selected_country}")
     else:
         # Load by Date Range (Month granularity)
-        # Generate list of YYYY/MM between start and end date
-        current = start_date.replace(day=1)
-        while current <= end_date:
-            ym = current.strftime('%Y/%m')
-            path = f"{BASE_PATH}/{selected_country}/{ym}.json"
-            files_to_load.add(path)
-
-            # Increment month
-            if current.month == 12:
-                current = current.replace(year=current.year + 1, month=1)
-            else:
-                current = current.replace(month=current.month + 1)
+        # Generate list of YYYY/MM between start and end date (month starts, inclusive)
+        yms = pd.date_range(
+            pd.Timestamp(start_date).to_period('M').to_timestamp(),
+            pd.Timestamp(end_date),
+            freq='MS'
+        ).strftime('%Y/%m')
+        files_to_load.update(f"{BASE_PATH}/{selected_country}/{ym}.parquet" for ym in yms)
 
     # --- Load & Process Data ---
     if not files_to_load:
@@ -198,63 +290,89 @@ def main():
         return
 
     with st.spinner(f"Loading {len(files_to_load)} files..."):
-        raw_reviews = load_reviews_data(list(files_to_load))
+        df = build_dataframe(sorted(files_to_load))
 
-    if not raw_reviews:
+    if df is None:
         st.info("No reviews found in the selected files.")
         return
 
-    df = pd.DataFrame(raw_reviews)
-
-    # Convert date to datetime
-    df['date'] = pd.to_datetime(df['date'])
-
     # Apply Filters
+    # All conditions are combined into one boolean mask and the frame is sliced once.
 
     # 1. Country (Already loaded by country, but double check data integrity)
-    df = df[df['country'] == selected_country]
+    mask = df['country'].values == selected_country
 
     # 2. Date Range
     # (We loaded whole months, so we must filter by precise date now)
-    df = df[(df['date'].dt.date >= start_date) & (df['date'].dt.date <= end_date)]
+    # .values is UTC datetime64; end_date is inclusive, hence the +1 day upper bound
+    dates = df['date'].values
+    mask &= (dates >= np.datetime64(start_date)) & (dates < np.datetime64(end_date) + np.timedelta64(1, 'D'))
 
     # 3. Version
     if use_version_filter and selected_version:
-        df = df[df['version'] == selected_version]
+        mask &= df['version'].values == selected_version
 
     # 4. Rating
-    df = df[df['rating'].isin(selected_ratings)]
+    mask &= df['rating'].isin(selected_ratings).values
 
-    # 5. Search
+    # 5. Search (plain substring match; every whitespace-separated keyword must match)
     if search_query:
-        query = search_query.lower()
-        df = df[
-            df['content'].str.lower().str.contains(query, na=False) |
-            df['title'].str.lower().str.contains(query, na=False)
-        ]
+        for query_lc in search_query.lower().split():
+            mask &= (
+                df['_content_lc'].str.contains(query_lc, regex=False, na=False).values |
+                df['_title_lc'].str.contains(query_lc, regex=False, na=False).values
+            )
+
+    df = df[mask]
 
     # --- Display ---
-    st.subheader(f"Reviews ({len(df)})")
+    total = len(df)
+    st.subheader(f"Reviews ({total})")
 
     # Sort by date desc
     df = df.sort_values(by='date', ascending=False)
 
-    for _, row in df.iterrows():
-        stars = "★" * int(row['rating']) + "☆" * (5 - int(row['rating']))
-
-        st.markdown(f"""
-        <div class="review-card">
-            <div class="review-header">
-                <span class="review-author">{row['user_name']}</span>
-                <span class="review-date">{row['date'].strftime('%Y-%m-%d')}</span>
-            </div>
-            <div class="review-rating">{stars}</div>
-            <div class="review-content">{row['content']}</div>
-            <div class="review-meta">
-                Version: {row['version']} | Source: {row['source']} | {row['country'].upper()}
-            </div>
-        </div>
-        """, unsafe_allow_html=True)
+    # Pagination: go back to the first page whenever the filters change
+    filter_key = (selected_country, selected_version, start_date, end_date, tuple(selected_ratings), search_query)
+    if st.session_state.get('filter_key') != filter_key:
+        st.session_state['filter_key'] = filter_key
+        st.session_state['offset'] = 0
+    offset = st.session_state['offset']
+
+    page = df.iloc[offset:offset + PAGE_SIZE]
+
+    # Build all cards as one HTML string and render it with a single st.markdown call
+    dates_str = page['date'].dt.strftime('%Y-%m-%d')
+    ratings = page['rating'].astype(int)
+    countries = page['country'].str.upper()
+
+    parts = []
+    append = parts.append
+    for user_name, date_str, rating, content, version, source, country in zip(
+        page['user_name'], dates_str, ratings, page['content'], page['version'], page['source'], countries
+    ):
+        append(f"""<div class="review-card">
+    <div class="review-header">
+        <span class="review-author">{user_name}</span>
+        <span class="review-date">{date_str}</span>
+    </div>
+    <div class="review-rating">{STARS[rating]}</div>
+    <div class="review-content">{content}</div>
+    <div class="review-meta">
+        Version: {version} | Source: {source} | {country}
+    </div>
+</div>""")
+
+    st.markdown("\n".join(parts), unsafe_allow_html=True)
+
+    if total > PAGE_SIZE:
+        def shift_page(delta):
+            st.session_state['offset'] = max(0, st.session_state['offset'] + delta)
+
+        col_prev, col_info, col_next = st.columns([1, 2, 1])
+        col_prev.button("← Previous", disabled=offset == 0, on_click=shift_page, args=(-PAGE_SIZE,))
+        col_info.caption(f"Showing {offset + 1}-{min(offset + PAGE_SIZE, total)} of {total}")
+        col_next.button("Next →", disabled=offset + PAGE_SIZE >= total, on_click=shift_page, args=(PAGE_SIZE,))
 
 if __name__ == "__main__":
     main()